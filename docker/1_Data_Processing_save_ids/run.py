@@ -2,46 +2,107 @@ import sys
 sys.path.append('../src')
 
 from wikidata_dumpreader import WikidataDumpReader
-from wikidataDB import WikidataID
-from multiprocessing import Manager
+from wikidataDB import WikidataID, POOL_SIZE, MAX_OVERFLOW
+import threading
+from queue import Queue, Full
+import os
 import asyncio
-import gc
+import time
 
 FILEPATH = '../data/Wikidata/latest-all.json.bz2'
 BATCH_SIZE = 1000
 QUEUE_SIZE = 1500
-NUM_PROCESSES = 4
+NUM_PROCESSES = int(os.environ.get('NUM_PROCESSES', 4)) # Consumer threads, each holding a database session
+MAX_CONSUMERS = POOL_SIZE + MAX_OVERFLOW - 1 # Database connections left for the consumers, one is kept for the writer thread
+DECOMPRESSION_THREADS = int(os.environ.get('DECOMPRESSION_THREADS', 4)) # Threads decompressing the bz2 dump with indexed_bzip2
 SKIPLINES = 0
 LANGUAGE = 'en'
+MAX_BACKOFF = 30 # Seconds
+MAX_WRITE_ATTEMPTS = 8 # Attempts per batch before the writer gives up and fails the stage
+WRITE_QUEUE_SIZE = 8 # Full batches waiting for the writer, consumers block once it is reached
 
-def save_ids_to_sqlite(item, bulk_ids, sqlitDBlock):
+consumer_buffers = threading.local()
+all_buffers = [] # The buffer of every consumer, flushed once the reader is done
+write_queue = Queue(maxsize=WRITE_QUEUE_SIZE)
+writer_failed = threading.Event() # Set when the writer thread dies, so the consumers stop instead of blocking on the full queue
+
+def get_local_buffer():
+    # Each consumer thread fills its own buffer, so no lock is needed around it.
+    if not hasattr(consumer_buffers, 'buffer'):
+        consumer_buffers.buffer = []
+        all_buffers.append(consumer_buffers.buffer)
+    return consumer_buffers.buffer
+
+def write_with_backoff(batch):
+    # Retry the flush with an exponential backoff while the database is busy, for up to MAX_WRITE_ATTEMPTS attempts.
+    # add_bulk_ids prints the error of each failed attempt; a permanent error (schema, bad row, full disk) then fails the stage instead of retrying forever.
+    backoff = 1
+    for attempt in range(1, MAX_WRITE_ATTEMPTS + 1):
+        if WikidataID.add_bulk_ids(batch):
+            return
+        print(f"Write attempt {attempt} of {MAX_WRITE_ATTEMPTS} failed for a batch of {len(batch)} rows")
+        if attempt < MAX_WRITE_ATTEMPTS:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+    raise RuntimeError(f"Could not write a batch of {len(batch)} rows after {MAX_WRITE_ATTEMPTS} attempts")
+
+def sqlite_writer():
+    # SQLite allows a single writer at a time, so one thread does every flush instead of the consumers competing for the lock
+    try:
+        while True:
+            batch = write_queue.get()
+            if batch is None:
+                break
+            write_with_backoff(batch)
+    except BaseException:
+        writer_failed.set()
+        raise
+
+def enqueue_write(batch):
+    # Wait for room in the write queue, raising instead if the writer has died and will never empty it
+    while not writer_failed.is_set():
+        try:
+            write_queue.put(batch, timeout=1)
+            return
+        except Full:
+            pass
+    raise RuntimeError("The SQLite writer thread failed, see its error above")
+
+def save_ids_to_sqlite(item):
     if (item is not None) and WikidataID.is_in_wikipedia(item, language=LANGUAGE):
         ids = WikidataID.extract_entity_ids(item, language=LANGUAGE)
+        bulk_ids = get_local_buffer()
         bulk_ids.extend(ids)
         del item
 
-        with sqlitDBlock:
-            if len(bulk_ids) > BATCH_SIZE:
-                worked = WikidataID.add_bulk_ids(list(bulk_ids[:BATCH_SIZE]))
-                if worked:
-                    del bulk_ids[:BATCH_SIZE]
-                    gc.collect()
+        if len(bulk_ids) >= BATCH_SIZE:
+            enqueue_write(list(bulk_ids))
+            bulk_ids.clear()
 
-async def run_processor(wikidata, bulk_ids, sqlitDBlock):
-    await wikidata.run(lambda item: save_ids_to_sqlite(item, bulk_ids, sqlitDBlock), max_iterations=None, verbose=True)
+async def run_processor(wikidata):
+    await wikidata.run(save_ids_to_sqlite, max_iterations=None, verbose=True)
 
 if __name__ == "__main__":
-    multiprocess_manager = Manager()
-    sqlitDBlock = multiprocess_manager.Lock()
-    bulk_ids = multiprocess_manager.list()
+    if NUM_PROCESSES > MAX_CONSUMERS:
+        print(f"NUM_PROCESSES={NUM_PROCESSES} is more than the {MAX_CONSUMERS} database connections available to the consumers, using {MAX_CONSUMERS} consumer threads")
+        NUM_PROCESSES = MAX_CONSUMERS
+
+    # Entities without a sitelink to the Wikipedia of LANGUAGE are dropped before being parsed
+    wikidata = WikidataDumpReader(FILEPATH, num_processes=NUM_PROCESSES, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, skiplines=SKIPLINES, decompression_threads=DECOMPRESSION_THREADS, line_filter=f'"{LANGUAGE}wiki":')
 
-    wikidata = WikidataDumpReader(FILEPATH, num_processes=NUM_PROCESSES, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, skiplines=SKIPLINES)
+    writer = threading.Thread(target=sqlite_writer)
+    writer.start()
 
-    asyncio.run(run_processor(wikidata, bulk_ids, sqlitDBlock))
+    try:
+        asyncio.run(run_processor(wikidata))
+    finally:
+        # Flush what the consumers buffered and stop the writer even if the run failed, so the container exits instead of hanging on the writer
+        if not writer_failed.is_set():
+            bulk_ids = [x for buffer in all_buffers for x in buffer]
+            if len(bulk_ids) > 0:
+                enqueue_write(bulk_ids)
+            enqueue_write(None)
+        writer.join()
 
-    while len(bulk_ids) > 0:
-        worked = WikidataID.add_bulk_ids(list(bulk_ids))
-        if worked:
-            bulk_ids[:] = []
-        else:
-            asyncio.sleep(1)
\ No newline at end of file
+    if writer_failed.is_set():
+        raise RuntimeError("The SQLite writer thread failed, see its error above")
\ No newline at end of file
@@ -1,30 +1,49 @@
 import sys
 sys.path.append('../src')
 
-from wikidataDB import Session, WikidataID, WikidataEntity
+from wikidataDB import engine, Session, WikidataID, WikidataEntity
 from wikidataEmbed import WikidataTextifier
 
 import json
+import orjson
+from sqlalchemy import Text, type_coerce
 from langchain_astradb import AstraDBVectorStore
-from langchain_core.documents import Document
 from astrapy.info import CollectionVectorServiceOptions
+from astrapy.exceptions import DataAPITimeoutException
+import httpx
 from transformers import AutoTokenizer
 from tqdm import tqdm
-from langchain_core.documents import Document
-import requests
 import time
+import random
+import os
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-datastax_token = json.load(open("../API_tokens/datastax_wikidata_nvidia.json"))
+with open("../API_tokens/datastax_wikidata_nvidia.json") as json_in:
+    datastax_token = json.load(json_in)
 ASTRA_DB_DATABASE_ID = datastax_token['ASTRA_DB_DATABASE_ID']
 ASTRA_DB_APPLICATION_TOKEN = datastax_token['ASTRA_DB_APPLICATION_TOKEN']
 ASTRA_DB_API_ENDPOINT = datastax_token["ASTRA_DB_API_ENDPOINT"]
 ASTRA_DB_KEYSPACE = datastax_token["ASTRA_DB_KEYSPACE"]
 
-BATCH_SIZE = 100
-OFFSET = 0
+BATCH_SIZE = 100 # Entities fetched from SQLite per round-trip
+UPLOAD_BATCH_SIZE = 500 # Chunks per add_texts call, the store splits them into concurrent insert requests
+NUM_PROCESSES = int(os.environ.get('NUM_PROCESSES', max(1, os.cpu_count() - 1))) # Textification worker processes, each opening its own database connections
+PREFETCH_SIZE = 20 # Entities textified by a worker per task, their referenced entities are fetched from SQLite together
+MAX_PENDING_TASKS = NUM_PROCESSES * 2 # Tasks submitted ahead to the textification workers
+NUM_UPLOAD_THREADS = 8 # Batches uploaded concurrently, uploads are bound by the HTTP round-trips to AstraDB
+MAX_PENDING_BATCHES = NUM_UPLOAD_THREADS * 2
+MAX_BACKOFF = 60 # Seconds
+MAX_UPLOAD_ATTEMPTS = 10 # Attempts per batch before the error is raised in the main thread
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504} # Rate limiting and server errors, worth retrying
+PROGRESS_INTERVAL = 1000 # Number of entities between progress reports
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1)) # Number of containers splitting the entities between them
+SHARD_ID = int(os.environ.get('SHARD_ID', 0)) # Shard handled by this container, from 0 to SHARD_COUNT-1
+RESUME_FILE = '../data/Wikidata/astradb_last_qid.txt' if SHARD_COUNT <= 1 else f'../data/Wikidata/astradb_last_qid_{SHARD_ID}_of_{SHARD_COUNT}.txt'
 
 textifier = WikidataTextifier(with_claim_aliases=False, with_property_aliases=False)
-tokenizer = AutoTokenizer.from_pretrained('intfloat/e5-large-unsupervised', trust_remote_code=True, clean_up_tokenization_spaces=False)
+tokenizer = AutoTokenizer.from_pretrained('intfloat/e5-large-unsupervised', use_fast=True, trust_remote_code=True, clean_up_tokenization_spaces=False) # chunk_text relies on the offset mappings of a fast tokenizer
 
 collection_vector_service_options = CollectionVectorServiceOptions(
     provider="nvidia",
@@ -39,38 +58,148 @@ graph_store = AstraDBVectorStore(
     namespace=ASTRA_DB_KEYSPACE,
 )
 
+def load_last_id():
+    # QID of the last entity pushed in a previous run, '' to start from the beginning
+    if os.path.exists(RESUME_FILE):
+        with open(RESUME_FILE) as f:
+            return f.read().strip()
+    return ''
+
+def save_last_id(qid):
+    with open(RESUME_FILE, 'w') as f:
+        f.write(qid)
+
+def is_transient_error(error):
+    # Timeouts, dropped connections, rate limiting and server errors can succeed on a retry.
+    # Any other error (authentication, payload too large, schema) is permanent. The wrapped causes are checked too, since the vector store may re-raise the client's errors.
+    while error is not None:
+        if isinstance(error, (DataAPITimeoutException, httpx.TimeoutException, httpx.TransportError, TimeoutError, ConnectionError)):
+            return True
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status_code is not None:
+            return status_code in TRANSIENT_STATUS_CODES
+        error = error.__cause__ or error.__context__
+    return False
+
+def push_batch(texts_batch, qids_batch, chunk_ids_batch):
+    # Runs on an upload thread, retrying transient errors with an exponential backoff for up to MAX_UPLOAD_ATTEMPTS attempts.
+    # Permanent errors and the last failed attempt are re-raised, so waiting on the batch fails the ingest in the main thread.
+    # The metadata dicts and document IDs are built here, off the main thread, from the parallel lists of the batch.
+    metadatas_batch = [{"QID": qid, "ChunkID": chunk_id} for qid, chunk_id in zip(qids_batch, chunk_ids_batch)]
+    ids_batch = [f"{qid}_{chunk_id}" for qid, chunk_id in zip(qids_batch, chunk_ids_batch)]
+    backoff = 1
+    for attempt in range(1, MAX_UPLOAD_ATTEMPTS + 1):
+        try:
+            graph_store.add_texts(texts_batch, metadatas=metadatas_batch, ids=ids_batch)
+            return
+        except Exception as e:
+            if (attempt == MAX_UPLOAD_ATTEMPTS) or not is_transient_error(e):
+                raise
+            print(f"Upload attempt {attempt} of {MAX_UPLOAD_ATTEMPTS} failed, retrying: {e}")
+            time.sleep(backoff + random.uniform(0, backoff)) # The jitter keeps the upload threads from retrying in lockstep
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+def get_shard_range(query):
+    # Splits the ordered entities in SHARD_COUNT contiguous QID ranges of about the same size.
+    # Returns the [start, end) QIDs of this shard, None when the range is unbounded on that side, and the number of entities in it.
+    total = query.count()
+    if SHARD_COUNT <= 1:
+        return None, None, total
+
+    ids = query.with_entities(WikidataEntity.id).order_by(WikidataEntity.id)
+    start_position = total * SHARD_ID // SHARD_COUNT
+    end_position = total * (SHARD_ID + 1) // SHARD_COUNT
+    start_id = ids.offset(start_position).limit(1).scalar() if SHARD_ID > 0 else None
+    end_id = ids.offset(end_position).limit(1).scalar() if SHARD_ID < SHARD_COUNT - 1 else None
+    return start_id, end_id, end_position - start_position
+
+# The columns selected for each entity, in query order. Entities travel to the workers as plain tuples and are read by chunk_text through attribute access.
+# The claims are selected as their raw JSON text, so the workers parse them in parallel instead of the main process decoding and pickling every nested dict.
+EntityRow = namedtuple('EntityRow', ['id', 'label', 'description', 'claims', 'aliases'])
+
+def init_worker():
+    # Forked workers must open their own SQLite connections instead of reusing the parent's pooled ones.
+    engine.dispose(close=False)
+
+def prepare_entity_group(entities):
+    # Runs in a worker process: converts a group of entities to text and splits them into chunks.
+    # The entities referenced by the whole group are fetched in one pass before textifying each entity.
+    entities = [EntityRow._make(entity) for entity in entities]
+    entities = [entity._replace(claims=orjson.loads(entity.claims) if entity.claims is not None else None) for entity in entities]
+    textifier.prefetch_entities(*[entity.claims for entity in entities])
+    return [(entity.id, textifier.chunk_text(entity, tokenizer)) for entity in entities]
+
+def prepare_entities(pool, entities):
+    # Yields (QID, chunks) in query order, keeping up to MAX_PENDING_TASKS groups of PREFETCH_SIZE entities in progress in the pool.
+    pending_tasks = deque()
+    entity_group = []
+    for entity in entities:
+        entity_group.append(tuple(entity))
+        if len(entity_group) >= PREFETCH_SIZE:
+            pending_tasks.append(pool.submit(prepare_entity_group, entity_group))
+            entity_group = []
+            if len(pending_tasks) >= MAX_PENDING_TASKS:
+                yield from pending_tasks.popleft().result()
+
+    if len(entity_group) > 0:
+        pending_tasks.append(pool.submit(prepare_entity_group, entity_group))
+
+    while len(pending_tasks) > 0:
+        yield from pending_tasks.popleft().result()
+
 if __name__ == "__main__":
-    with tqdm(total=9203531) as progressbar:
+    # Upload threads push batches to AstraDB concurrently while the next ones are being textified and tokenized.
+    # At most MAX_PENDING_BATCHES batches are in flight, and waiting on them re-raises any upload error in the main thread.
+    # Batches are awaited in submission order, so the resume QID is only saved once every batch before it is pushed.
+    # Textification and tokenization are CPU bound and run in a pool of worker processes, the main process only streams entities from SQLite and submits the batches.
+    # The workers are forked so they inherit the API token, tokenizer and textifier loaded at import instead of re-importing this script.
+    # Set SHARD_COUNT and SHARD_ID to scale out over several containers, each one owns a disjoint range of QIDs.
+    with tqdm() as progressbar, ProcessPoolExecutor(max_workers=NUM_PROCESSES, initializer=init_worker, mp_context=multiprocessing.get_context('fork')) as pool, ThreadPoolExecutor(max_workers=NUM_UPLOAD_THREADS) as executor:
         with Session() as session:
-            entities = session.query(WikidataEntity).join(WikidataID, WikidataEntity.id == WikidataID.id).filter(WikidataID.in_wikipedia == True).offset(OFFSET).yield_per(BATCH_SIZE)
-            progressbar.update(OFFSET)
-            doc_batch = []
-            ids_batch = []
+            # Keyset pagination: resuming seeks directly into the primary key index instead of scanning OFFSET rows.
+            # The last pushed entity is included again since only part of its chunks may have been pushed; its chunk IDs are overwritten.
+            last_id = load_last_id()
+            # Only the columns are selected, the textification workers receive plain values so no ORM objects or identity map entries are built per entity.
+            query = session.query(WikidataEntity.id, WikidataEntity.label, WikidataEntity.description, type_coerce(WikidataEntity.claims, Text).label('claims'), WikidataEntity.aliases).join(WikidataID, WikidataEntity.id == WikidataID.id).filter(WikidataID.in_wikipedia == True)
+            start_id, end_id, shard_size = get_shard_range(query)
+            progressbar.reset(total=shard_size)
+            if start_id is not None:
+                query = query.filter(WikidataEntity.id >= start_id)
+            if end_id is not None:
+                query = query.filter(WikidataEntity.id < end_id)
+            if last_id:
+                progressbar.update(query.filter(WikidataEntity.id < last_id).count())
+                query = query.filter(WikidataEntity.id >= last_id)
+            entities = query.order_by(WikidataEntity.id).execution_options(stream_results=True).yield_per(BATCH_SIZE)
+            texts_batch = []
+            qids_batch = []
+            chunk_ids_batch = []
+            pending_batches = deque()
 
-            for entity in entities:
+            for qid, chunks in prepare_entities(pool, entities):
                 progressbar.update(1)
-                chunks = textifier.chunk_text(entity, tokenizer)
-                for chunk_i in range(len(chunks)):
-                    doc = Document(page_content=chunks[chunk_i], metadata={"QID": entity.id, "ChunkID": chunk_i+1})
-                    doc_batch.append(doc)
-                    ids_batch.append(f"{entity.id}_{chunk_i+1}")
-
-                    if len(doc_batch) >= BATCH_SIZE:
-                        tqdm.write(progressbar.format_meter(progressbar.n, progressbar.total, progressbar.format_dict["elapsed"])) # tqdm is not wokring in docker compose. This is the alternative
-                        try:
-                            graph_store.add_documents(doc_batch, ids=ids_batch)
-                            doc_batch = []
-                            ids_batch = []
-                        except Exception as e:
-                            print(e)
-                            while True:
-                                try:
-                                    response = requests.get("https://www.google.com", timeout=5)
-                                    if response.status_code == 200:
-                                        break
-                                except Exception as e:
-                                    print("Waiting for internet connection...")
-                                    time.sleep(5)
-
-            if len(doc_batch) > 0:
-                graph_store.add_documents(doc_batch, ids=ids_batch)
\ No newline at end of file
+                if progressbar.n % PROGRESS_INTERVAL == 0:
+                    tqdm.write(progressbar.format_meter(progressbar.n, progressbar.total, progressbar.format_dict["elapsed"])) # tqdm is not wokring in docker compose. This is the alternative
+
+                for chunk_id, chunk in enumerate(chunks, start=1):
+                    texts_batch.append(chunk)
+                    qids_batch.append(qid)
+                    chunk_ids_batch.append(chunk_id)
+
+                    if len(texts_batch) >= UPLOAD_BATCH_SIZE:
+                        pending_batches.append((executor.submit(push_batch, texts_batch, qids_batch, chunk_ids_batch), qid))
+                        if len(pending_batches) >= MAX_PENDING_BATCHES:
+                            future, batch_last_id = pending_batches.popleft()
+                            future.result()
+                            save_last_id(batch_last_id)
+
+                        texts_batch = []
+                        qids_batch = []
+                        chunk_ids_batch = []
+
+            if len(texts_batch) > 0:
+                pending_batches.append((executor.submit(push_batch, texts_batch, qids_batch, chunk_ids_batch), qids_batch[-1]))
+
+            for future, batch_last_id in pending_batches:
+                future.result()
+                save_last_id(batch_last_id)
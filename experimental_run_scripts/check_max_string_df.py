@@ -1,21 +1,26 @@
-import sys
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool
+from tqdm import tqdm
 
 max_string_len = 0
 max_string_bytes = 0
 
 
 def return_max(chunk):
-    max_len = max(len(l_.item_str) for _, l_ in chunk.iterrows())
-    max_mem = max(sys.getsizeof(l_.item_str) for _, l_ in chunk.iterrows())
-    return max_len, max_mem
+    # Bytes are the UTF-8 encoded length, the same metric as max_max_load
+    item_str = chunk['item_str']
+    max_len = item_str.str.len().max()
+    max_bytes = item_str.str.encode('utf-8').str.len().max()
+    return max_len, max_bytes
 
 
 def max_max_pool(filename):
-    filename = 'csvfiles/wikidata_vectordb_datadump_item_chunks_1000000_en.csv'
     with Pool(cpu_count()) as pool:
         # Wrap pool.imap with tqdm for progress tracking
         pool_imap = pool.imap(
@@ -26,14 +31,21 @@ def max_max_pool(filename):
 
 
 def max_max_load(filename, embed_chunksize=256):
-    filename = 'csvfiles/wikidata_vectordb_datadump_item_chunks_1000000_en.csv'
-    df = pd.read_csv(filename)
-    max_string_len = 0
-    max_string_bytes = 0
-
-    for _, line_ in tqdm(df.iterrows()):
-        max_string_len = max(max_string_len, len(line_.item_str))
-        max_string_bytes = max(max_string_bytes, sys.getsizeof(line_.item_str))
+    # pyarrow parses only the `item_str` column with multiple threads, and
+    #   the maxima are computed on the Arrow strings without converting them
+    #   to Python objects; the bytes are the UTF-8 encoded length, as in
+    #   return_max
+    table = pacsv.read_csv(
+        filename,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=['item_str'],
+            column_types={'item_str': pa.large_string()}
+        )
+    )
+    item_str = table['item_str']
+    max_string_len = pc.max(pc.utf8_length(item_str)).as_py()
+    max_string_bytes = pc.max(pc.binary_length(item_str)).as_py()
+
     print(max_string_len)
     print(max_string_bytes)
     print(max_string_bytes/max_string_len)
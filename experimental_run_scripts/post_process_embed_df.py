@@ -1,7 +1,11 @@
 import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
 
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer
 from time import time
 from tqdm import tqdm
@@ -17,58 +21,90 @@ except Exception as e:
     USE_LOCAL = True
 
 
+@lru_cache(maxsize=1)
 def is_docker():
     """Check if the script is running inside a Docker container."""
-    # Check for .dockerenv file
     if os.path.exists('/.dockerenv'):
         return True
 
-    # Check for Docker-specific entries in /proc/1/cgroup
     try:
-        with open('/proc/1/cgroup', 'rt') as f:
-            for line in f:
-                if 'docker' in line:
-                    return True
-    except Exception:
-        pass
+        with open('/proc/1/cgroup', 'rt', errors='ignore') as fproc:
+            cgroup = fproc.read()
+    except OSError:
+        return False
 
-    return False
+    return 'docker' in cgroup or 'kubepods' in cgroup
 
 
 def post_process_embed_df(df, embedder, embed_batchsize=120):
     start = time()
     n_rows = df.index.size
-    pbar = tqdm(df.iterrows(), total=n_rows)
+    statements = df['statement'].tolist()
+
+    # Encode slices of the statement column into one preallocated array,
+    #   instead of building a Series per row with iterrows and writing each
+    #   cell back with df.at
+    embeddings = None
+    pbar = tqdm(total=n_rows)
+    for k in range(0, n_rows, embed_batchsize):
+        embeddings_ = embedder.encode(
+            statements[k:k + embed_batchsize],
+            batch_size=embed_batchsize,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
+        if embeddings is None:
+            embeddings = np.empty(
+                (n_rows, embeddings_.shape[1]), dtype=embeddings_.dtype
+            )
+
+        embeddings[k:k + len(embeddings_)] = embeddings_
+        pbar.update(len(embeddings_))
+
+    pbar.close()
+
+    if embeddings is not None:
+        # Lists keep the CSV output as '[x, y, ...]' for the astrapy loader
+        df['embedding'] = pd.Series(embeddings.tolist(), index=df.index)
 
-    stack_rows = []
-    for _, row_ in pbar:
-        stack_rows.append(row_)
-        if len(stack_rows) == embed_batchsize:
-            statements = [row_.statement for row_ in stack_rows]
-            inds = [row_.name for row_ in stack_rows]
-            embeddings_ = embedder.encode(statements)
+    print(f'Operation took {time() - start:.1f} seconds.')
+    return df
 
-            for ind_, embed_ in zip(inds, embeddings_):
-                df.at[ind_, 'embedding'] = embed_.tolist()
 
-            # Reset batch
-            stack_rows = []
+def to_parquet_embedded_df(df, out_filepath, quantize=True):
+    """Write the embedded DataFrame to Parquet, with the embeddings stored
+    as a fixed size list column instead of ASCII floats. With `quantize`
+    the vectors are stored as int8 plus a per-vector float32 `scale`, such
+    that embedding ~= embedding_i8 / scale."""
+    embeddings = np.asarray(df['embedding'].tolist(), dtype=np.float32)
+    dim = embeddings.shape[1]
 
-            ratio_done = (n_rows - df['embedding'].isnull().sum()) / n_rows
-            pbar.set_description(f'{ratio_done:0.1%}')
-            pbar.refresh()  # to show immediately the update
+    table = pa.Table.from_pandas(
+        df.drop(columns='embedding'), preserve_index=False
+    )
 
-    if stack_rows:
-        print(f'Wrapping up trailing {len(stack_rows)} rows.')
-        statements = [row_.statement for row_ in stack_rows]
-        inds = [row_.name for row_ in stack_rows]
-        embeddings_ = embedder.encode(statements)
+    if quantize:
+        max_abs = np.abs(embeddings).max(axis=1, keepdims=True)
+        scale = 127.0 / np.maximum(max_abs, np.finfo(np.float32).tiny)
+        quantized = np.round(embeddings * scale).astype(np.int8)
+
+        table = table.append_column(
+            'embedding_i8',
+            pa.FixedSizeListArray.from_arrays(pa.array(quantized.ravel()), dim)
+        )
+        table = table.append_column(
+            'scale', pa.array(scale.ravel().astype(np.float32))
+        )
+    else:
+        table = table.append_column(
+            'embedding',
+            pa.FixedSizeListArray.from_arrays(
+                pa.array(embeddings.ravel()), dim
+            )
+        )
 
-        for ind_, embed_ in zip(inds, embeddings_):
-            df.at[ind_, 'embedding'] = embed_.tolist()
-
-    print(f'Operation took {time() - start:.1f} seconds.')
-    return df
+    pq.write_table(table, out_filepath, compression='zstd')
 
 
 if __name__ == '__main__':
@@ -80,14 +116,21 @@ if __name__ == '__main__':
     else:
         csv_filepath = (f'./csvfiles/{csv_filename}')
 
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
     # Initialize the SentenceTransformer model
     embedder = SentenceTransformer(
         "jinaai/jina-embeddings-v2-base-en",
-        trust_remote_code=True
+        trust_remote_code=True,
+        device=device
     )
 
-    # Set the batch size for embedding
+    # Set the batch size for embedding: the GPU only saturates with large
+    #   batches, and FP16 halves the activation memory they need
     embed_batchsize = 100
+    if device == 'cuda':
+        embedder.half()
+        embed_batchsize = 1024
 
     # Load the DataFrame from a CSV file
     df_100000 = pd.read_csv(csv_filepath)
@@ -103,10 +146,23 @@ if __name__ == '__main__':
         embed_batchsize=embed_batchsize
     )
 
+    # The CSV is what wikidata_astrapy_pipeline_from_csv uploads; Parquet is
+    #   a smaller columnar copy for local search and analysis
+    OUT_FORMAT = os.environ.get('OUT_FORMAT', 'csv')
+    QUANTIZE = os.environ.get('QUANTIZE', 'true').lower() == 'true'
+
     outfilename = 'wikidata_vectordb_datadump_100000_embedded_en.csv'
+    if OUT_FORMAT == 'parquet':
+        outfilename = outfilename.replace('.csv', '.parquet')
+
     if IS_DOCKER:
         out_filepath = (f'/home/dockeruser/csvfiles/{outfilename}')
     else:
         out_filepath = (f'./csvfiles/{outfilename}')
 
-    df_1e5_embedded.to_csv(out_filepath, index=False)
+    if OUT_FORMAT == 'parquet':
+        to_parquet_embedded_df(
+            df_1e5_embedded, out_filepath, quantize=QUANTIZE
+        )
+    else:
+        df_1e5_embedded.to_csv(out_filepath, index=False)
@@ -1,98 +1,62 @@
-import ast
 import astrapy
 import numpy as np
 import os
 import pandas as pd
-import re
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import sys
 import uuid
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from tqdm import tqdm
 
 
+@lru_cache(maxsize=1)
 def is_docker():
     """Check if the script is running inside a Docker container."""
-    with open('/proc/1/cgroup', 'rt') as fproc:
-        return (
-            os.path.exists('/.dockerenv')
-            or any('docker' in line for line in fproc)
-        )
-
-
-"""
-def is_docker():
-    '''Check if the script is running inside a Docker container.'''
-    # Check for .dockerenv file
     if os.path.exists('/.dockerenv'):
         return True
 
-    # Check for Docker-specific entries in /proc/1/cgroup
     try:
-        with open('/proc/1/cgroup', 'rt') as f:
-            for line in f:
-                if 'docker' in line:
-                    return True
-    except Exception:
-        pass
+        with open('/proc/1/cgroup', 'rt', errors='ignore') as fproc:
+            cgroup = fproc.read()
+    except OSError:
+        return False
 
-    return False
-"""
-
-
-def vector_str_manipulation(vector_str):
-    """Convert vector string to a list of floats."""
-    return re.sub(r'\s+', ',', vector_str).replace('[,', '[').replace(',]', ']')
-    # return vector_str.replace('[,', '[').replace(',]', ']')
+    return 'docker' in cgroup or 'kubepods' in cgroup
 
 
-"""
 def vector_str_manipulation(vector_str):
-    # Function to convert vector string to list of floats
-    while '  ' in vector_str:
-        vector_str = vector_str.replace('  ', ' ')
+    """Strip the brackets and commas of a vector string, leaving whitespace
+    separated floats."""
+    return vector_str.strip().strip('[]').replace(',', ' ')
 
-    vector_str = vector_str.replace(' ', ',')
 
-    while ',,' in vector_str:
-        vector_str = vector_str.replace(',,', ',')
-
-    return vector_str.replace('[,', '[').replace(',]', ']')
-"""
+def parse_vector_str(vector_str):
+    """Parse the string representation of a vector to an array of floats."""
+    # NumPy parses all the floats in C, instead of literal_eval building
+    #   the list element by element
+    return np.fromstring(vector_str_manipulation(vector_str), sep=' ')
 
 
 def convert_vector(vector_str):
-    """Convert string representation of a vector to a list of floats."""
-    vector_str = vector_str_manipulation(vector_str)
+    """Convert string representation of a vector to an array of floats."""
     if isinstance(vector_str, str):
-        return [float(x) for x in ast.literal_eval(vector_str)]
+        return parse_vector_str(vector_str)
     elif isinstance(vector_str, (float, np.ndarray)):
-        return list(vector_str)
+        return np.atleast_1d(vector_str)
     else:
         raise TypeError(f'Unsupported type: {type(vector_str)}')
 
 
-"""
-def convert_vector(vector_str):
-    # print(f'{vector_str=}')
-    vector_str = vector_str_manipulation(vector_str)
-
-    if isinstance(vector_str, str):
-        return [float(x) for x in ast.literal_eval(vector_str)]
-    elif isinstance(vector_str, float):
-        return [vector_str]
-    elif isinstance(vector_str, np.array):
-        return list(vector_str)
-    else:
-        print(f'{type(vector_str)=}')
-        return vector_str
-"""
-
 # Function to generate documents from CSV rows
 
 
-def generate_statement_document(row, embedding):
+def generate_statement_document(row, converter=convert_vector):
     return {
-        "_id": "_id": row.get("uuid", str(uuid.uuid4())),
+        "_id": row.get("uuid") or str(uuid.uuid4()),
         "qid": row["qid"],
         "pid": row["pid"],
         "value": row["value"],
@@ -101,13 +65,13 @@ def generate_statement_document(row, embedding):
         "value_content": row["value_content"],
         "statement": row["statement"],
         # Convert string to vector
-        "embedding": convert_vector(row["embedding"])
+        "embedding": converter(row["embedding"])
     }
 
 
-def generate_item_document(row, embedding):
+def generate_item_document(row, converter=convert_vector):
     return {
-        "_id": "_id": row.get("uuid", str(uuid.uuid4())),
+        "_id": row.get("uuid") or str(uuid.uuid4()),
         "qid": row["qid"],
         "chunk_id": row["chunk_id"],
         "qid_chunk": row["qid_chunk"],
@@ -117,70 +81,170 @@ def generate_item_document(row, embedding):
         "n_lines": row["n_lines"],
         "item_str": row["item_str"],
         # Convert string to vector
-        "embedding": convert_vector(row["embedding"])
+        "embedding": converter(row["embedding"])
     }
 
 
-def generate_document(row, pipeline='item'):
+def generate_document(row, pipeline='item', converter=convert_vector):
     """Generate a document based on the pipeline type."""
     if pipeline == 'item':
-        return generate_item_document(row)
+        return generate_item_document(row, converter=converter)
     elif pipeline == 'statement':
-        return generate_statement_document(row)
+        return generate_statement_document(row, converter=converter)
     else:
         raise ValueError(f'Unknown pipeline type: {pipeline}')
 
 # Batch insert documents into the collection
 
 
-def batch_insert_documents(collection, documents, label=''):
+def insert_one_document(collection, doc_, embedding_):
+    """Insert a single document, returning the error instead of raising."""
+    try:
+        collection.insert_one(doc_, vector=np.asarray(embedding_).tolist())
+    except Exception as err:
+        return err
+
+
+def batch_insert_documents(
+        collection, documents, label='', n_fallback_workers=4):
     """Batch insert documents into the collection."""
-    embeddings_ = [doc["embedding"] for doc in documents]
-    documents_ = [
-        {key: val for key, val in doc.items() if key != 'embedding'}
-        for doc in documents
-    ]
+    # The documents are built per chunk, so pop the embedding in place
+    #   instead of copying every dict without it
+    documents_ = documents
+    embeddings_ = [doc.pop("embedding") for doc in documents_]
 
     try:
-        collection.insert_many(documents_, vectors=embeddings_)
+        # Stack the batch into one (B, D) array so the conversion to the JSON
+        #   friendly lists happens in a single C call rather than per row. A
+        #   malformed embedding fails the stack, and its document is then
+        #   inserted one by one like any other failed batch
+        collection.insert_many(
+            documents_, vectors=np.stack(embeddings_).tolist()
+        )
     except Exception as err:
         # TODO: introduce recursive looking
         uuid_err_counter = 0
+        inner_errors = []
+
+        # Each insert_one is a full network round-trip, so overlap a few of
+        #   them; the upload already runs several batches at once, so keep
+        #   `n_fallback_workers` small to not flood Astra DB
+        with ThreadPoolExecutor(
+                max_workers=n_fallback_workers) as fallback_executor:
+            errors = fallback_executor.map(
+                lambda pair: insert_one_document(collection, *pair),
+                zip(documents_, embeddings_)
+            )
+
+            # No progress bar here: the caller already tracks the chunks
+            for err2 in errors:
+                if err2 is None:
+                    continue
 
-        for embedding_, doc_ in tqdm(zip(embeddings_, documents_)):
-            try:
-                collection.insert_one(doc_, vector=embedding_)
-            except Exception as err2:
                 uuid_err = "Failed to insert document with _id"
                 # uuid_err = "Document already exists with the given _id"
 
                 if uuid_err not in str(err2):
-                    print(f'Inner error: {err2}')
+                    inner_errors.append(err2)
                 else:
                     uuid_err_counter = uuid_err_counter + 1
 
-            print(f'Number of UUID already exists errors: {uuid_err_counter}')
+        if inner_errors:
+            print(f'Inner errors ({len(inner_errors)}): {inner_errors}')
+
+        print(f'Number of UUID already exists errors: {uuid_err_counter}')
 
 
 # Read CSV in chunks and upload to Astra DB
 
+# Text and ID columns of both pipelines. Their types are declared up front
+#   because open_csv infers the types from the first block only: a column
+#   such as `value` can look numeric early in the file and hold text later
+TEXT_COLUMNS = [
+    'qid', 'pid', 'value', 'item_label', 'property_label', 'value_content',
+    'statement', 'qid_chunk', 'item_str', 'uuid', 'embedding'
+]
+COUNT_COLUMNS = [
+    'chunk_id', 'n_statements', 'n_sitelinks', 'n_descriptions', 'n_lines'
+]
+
+
+def read_csv_chunks(csv_file, ch_size=100, block_size=8 << 20):
+    """Stream the rows of a CSV file as lists of `ch_size` dicts."""
+    # pyarrow parses blocks of `block_size` bytes with multiple threads,
+    #   the blocks are then regrouped into chunks of `ch_size` rows
+    reader = pacsv.open_csv(
+        csv_file,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(
+            column_types={
+                **{column: pa.large_string() for column in TEXT_COLUMNS},
+                **{column: pa.int64() for column in COUNT_COLUMNS}
+            }
+        )
+    )
+
+    rows = []
+    for batch in reader:
+        rows.extend(batch.to_pylist())
+        n_full = len(rows) - len(rows) % ch_size
+        for start in range(0, n_full, ch_size):
+            yield rows[start:start + ch_size]
+
+        rows = rows[n_full:]
+
+    if rows:
+        yield rows
+
 
 def upload_csv_to_astra(
-        collection, csv_file=None, df=None, ch_size=100, pipeline='item'):
-
-    if csv_file is not None and df is None:
-        iterator = enumerate(pd.read_csv(csv_file, chunksize=ch_size))
-        for k, chunk in tqdm(iterator):
-            documents = [
-                generate_document(row, pipeline=pipeline)
-                for index, row in chunk.iterrows()
-            ]
-            batch_insert_documents(collection, documents, label=k)
-    elif df is not None:
-        iterator = enumerate(pd.read_csv(csv_file, chunksize=ch_size))
-        for k, row in tqdm(df.iterrows()):
-            documents = [generate_document(row)]
-            batch_insert_documents(collection, documents, label=k)
+        collection, csv_file=None, df=None, ch_size=100, pipeline='item',
+        n_workers=4):
+
+    # Inserts run on `n_workers` threads while the next chunks are parsed,
+    #   with at most 2 * `n_workers` chunks in flight to bound memory
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+
+        def submit_insert(documents, label):
+            pending.append(executor.submit(
+                batch_insert_documents, collection, documents, label=label
+            ))
+            if len(pending) >= 2 * n_workers:
+                pending.popleft().result()
+
+        if csv_file is not None and df is None:
+            # The embedding column is always read as a string, so skip the
+            #   per-row type dispatch of convert_vector
+            iterator = enumerate(read_csv_chunks(csv_file, ch_size=ch_size))
+            for k, chunk in tqdm(iterator):
+                documents = [
+                    generate_document(
+                        row, pipeline=pipeline, converter=parse_vector_str
+                    )
+                    for row in chunk
+                ]
+                submit_insert(documents, label=k)
+        elif df is not None:
+            # to_dict builds the row dicts in one pass, unlike iterrows
+            #   which materialises a Series per row; converting one slice at
+            #   a time keeps only the in-flight chunks as Python dicts
+            converter = convert_vector
+            if len(df) and isinstance(df['embedding'].iloc[0], str):
+                converter = parse_vector_str
+
+            for k in tqdm(range(0, len(df), ch_size)):
+                documents = [
+                    generate_document(
+                        row, pipeline=pipeline, converter=converter
+                    )
+                    for row in df.iloc[k:k + ch_size].to_dict(orient='records')
+                ]
+                submit_insert(documents, label=k)
+
+        # Re-raise any error from the remaining inserts
+        for future in pending:
+            future.result()
 
 
 def confirm_drop_collection(collection):
@@ -2,6 +2,7 @@ import bz2
 import dask.dataframe as dd
 import json
 import logging
+import orjson
 import os
 import pandas as pd
 import requests
@@ -12,6 +13,7 @@ import subprocess
 import sys
 import torch
 
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool as ThreadPool
@@ -36,22 +38,19 @@ except Exception as e:
     USE_LOCAL = True
 
 
+@lru_cache(maxsize=1)
 def is_docker():
     """Check if the script is running inside a Docker container."""
-    # Check for .dockerenv file
     if os.path.exists('/.dockerenv'):
         return True
 
-    # Check for Docker-specific entries in /proc/1/cgroup
     try:
-        with open('/proc/1/cgroup', 'rt') as f:
-            for line in f:
-                if 'docker' in line:
-                    return True
-    except Exception:
-        pass
+        with open('/proc/1/cgroup', 'rt', errors='ignore') as fproc:
+            cgroup = fproc.read()
+    except OSError:
+        return False
 
-    return False
+    return 'docker' in cgroup or 'kubepods' in cgroup
 
 
 def embedd_jina_api(statement):
@@ -604,15 +603,16 @@ def stream_etl_wikidata_datadump(
                 break
 
             n_items = n_items + 1
-            line = line.decode().strip()
+            # orjson parses the raw bytes, skipping the decode to str
+            line = line.strip()
 
-            if line in {'[', ']'}:
+            if line in {b'[', b']'}:
                 continue
 
-            if line.endswith(','):
+            if line.endswith(b','):
                 line = line[:-1]
 
-            entity = json.loads(line)
+            entity = orjson.loads(line)
 
             if 'sitelinks' not in entity.keys():
                 continue
@@ -708,7 +708,15 @@ def query_pid_label(conn, pid):
     return cur.fetchone()
 
 
+# Property labels are looked up for nearly every claim, so they are only
+#   queried once per PID
+pid_label_cache = {}
+
+
 def query_label(conn, qpid, field='qid'):
+    if field == 'pid' and qpid in pid_label_cache:
+        return pid_label_cache[qpid]
+
     cur = conn.cursor()
     query = f"""select * from {field}_labels where {field} == '{qpid}';"""
     try:
@@ -717,7 +725,13 @@ def query_label(conn, qpid, field='qid'):
         print(f'Error: {e}')
         print(f'Query: {query}')
 
-    return cur.fetchone()
+    label_row = cur.fetchone()
+    if field == 'pid' and label_row is not None:
+        # Failed lookups are not cached, so a transient error is retried on
+        #   the next statement with this PID
+        pid_label_cache[qpid] = label_row
+
+    return label_row
 
 
 def load_qid_label_csv(filename):
@@ -799,6 +813,7 @@ def post_process_embed_df(df, embedder, batchsize=120):
     n_rows = df.index.size
     pbar = tqdm(df.iterrows(), total=n_rows)
 
+    n_done = 0
     stack_rows = []
     for _, row_ in pbar:
         stack_rows.append(row_)
@@ -810,10 +825,14 @@ def post_process_embed_df(df, embedder, batchsize=120):
             for ind_, embed_ in zip(inds, embeddings_):
                 df.at[ind_, 'embedding'] = embed_.tolist()
 
+            # Count the embedded rows rather than rescanning the whole
+            #   embedding column with isnull() after every batch
+            n_done = n_done + len(stack_rows)
+
             # Reset batch
             stack_rows = []
 
-            ratio_done = (n_rows - df['embedding'].isnull().sum()) / n_rows
+            ratio_done = n_done / n_rows
             pbar.set_description(f'{ratio_done:0.1%}')
             pbar.refresh()  # to show immediately the update
 
@@ -1,31 +1,66 @@
-from sqlalchemy import Column, Text, Boolean, create_engine, text
+from sqlalchemy import Column, Text, Boolean, create_engine, text, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.types import TypeDecorator
-import json
+import orjson
+
+POOL_SIZE = 5 # Limit the number of open connections
+MAX_OVERFLOW = 10 # Allow extra connections beyond POOL_SIZE
 
 engine = create_engine('sqlite:///../data/Wikidata/sqlite_enwiki.db',
-    pool_size=5,       # Limit the number of open connections
-    max_overflow=10,   # Allow extra connections beyond pool_size
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
     pool_recycle=10  # Recycle connections every 10 seconds
 )
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Configure every new SQLite connection for write-heavy bulk ingestion."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer
+    cursor.execute("PRAGMA synchronous=NORMAL")  # fsync only at WAL checkpoints
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=10737418240")  # 10 GB
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+    cursor.execute("PRAGMA busy_timeout=5000")  # Wait for the lock instead of failing
+    cursor.close()
+
 Base = declarative_base()
 Base.metadata.create_all(engine)
 
 Session = sessionmaker(bind=engine)
 
+MAX_SQL_VARIABLES = 999 # SQLite's default limit of bound parameters per statement
+
+def execute_multi_values(session, statement, columns, data):
+    """
+    Execute an INSERT statement with as many rows per statement as SQLite allows (INSERT ... VALUES (...), (...), ...) instead of one execution per row.
+
+    Parameters:
+    - session: The session in which the statements are executed.
+    - statement: The SQL statement, with a `{values}` placeholder for the rows.
+    - columns: The column names, in the order they appear in the statement.
+    - data: A list of dictionaries representing the rows.
+    """
+    rows_per_statement = MAX_SQL_VARIABLES // len(columns)
+    for i in range(0, len(data), rows_per_statement):
+        rows = data[i:i+rows_per_statement]
+        values = ', '.join('(' + ', '.join(f':{column}_{j}' for column in columns) + ')' for j in range(len(rows)))
+        params = {f'{column}_{j}': row[column] for j, row in enumerate(rows) for column in columns}
+        session.execute(text(statement.format(values=values)), params)
+
 class JSONType(TypeDecorator):
     """Custom SQLAlchemy type for JSON storage in SQLite."""
     impl = Text
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            return json.dumps(value, separators=(',', ':'))
+            return orjson.dumps(value).decode('utf-8')
         return None
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            return json.loads(value)
+            return orjson.loads(value)
         return None
 
 class WikidataEntity(Base):
@@ -51,14 +86,14 @@ class WikidataEntity(Base):
         worked = False
         with Session() as session:
             try:
-                session.execute(
-                    text(
-                        """
-                        INSERT INTO wikidata (id, label, description, claims, aliases)
-                        VALUES (:id, :label, :description, :claims, :aliases)
-                        ON CONFLICT(id) DO NOTHING
-                        """
-                    ),
+                execute_multi_values(
+                    session,
+                    """
+                    INSERT INTO wikidata (id, label, description, claims, aliases)
+                    VALUES {values}
+                    ON CONFLICT(id) DO NOTHING
+                    """,
+                    ['id', 'label', 'description', 'claims', 'aliases'],
                     data
                 )
                 session.commit()
@@ -117,6 +152,32 @@ class WikidataEntity(Base):
         with Session() as session:
             return session.query(WikidataEntity).filter_by(id=id).first()
 
+    @staticmethod
+    def get_entities(ids, batch_size=500, with_claims=True):
+        """
+        Retrieve multiple entities by ID, with one `IN` query per batch of IDs instead of one query per ID.
+
+        Parameters:
+        - ids: An iterable of unique identifiers of the entities to be retrieved.
+        - batch_size: Maximum number of IDs bound in a single query (default is 500, below SQLite's limit of 999 parameters).
+        - with_claims: If False, only the id, label, description and aliases are loaded, skipping the parsing of the claims JSON (default is True).
+
+        Returns:
+        - A dictionary mapping each ID found in the database to its entity object, or to a row with the loaded columns if with_claims is False.
+        """
+        ids = list(set(ids))
+        entities = {}
+        with Session() as session:
+            if with_claims:
+                query = session.query(WikidataEntity)
+            else:
+                query = session.query(WikidataEntity.id, WikidataEntity.label, WikidataEntity.description, WikidataEntity.aliases)
+
+            for i in range(0, len(ids), batch_size):
+                for entity in query.filter(WikidataEntity.id.in_(ids[i:i+batch_size])):
+                    entities[entity.id] = entity
+        return entities
+
     @staticmethod
     def normalise_item(item, language='en'):
         """
@@ -137,32 +198,33 @@ class WikidataEntity(Base):
             'id': item['id'],
             'label': label,
             'description': description,
-            'aliases': json.dumps(aliases, separators=(',', ':')),
-            'claims': json.dumps(claims, separators=(',', ':')),
+            'aliases': orjson.dumps(aliases).decode('utf-8'),
+            'claims': orjson.dumps(claims).decode('utf-8'),
         }
 
 
     @staticmethod
-    def _remove_keys(data, keys_to_remove=['hash', 'property', 'numeric-id', 'qualifiers-order']):
+    def _remove_keys(data, keys_to_remove=('hash', 'property', 'numeric-id', 'qualifiers-order')):
         """
-        Remove unnecessary keys from a nested data structure before storing.
+        Remove unnecessary keys from a nested data structure before storing. The structure is modified in place, walking it with a stack instead of rebuilding every nested dictionary and list.
 
         Parameters:
         - data: The data structure (dictionary or list) from which keys need to be removed.
-        - keys_to_remove: A list of keys to be removed (default is ['hash', 'property', 'numeric-id', 'qualifiers-order']).
+        - keys_to_remove: The keys to be removed (default is ('hash', 'property', 'numeric-id', 'qualifiers-order')).
 
         Returns:
         - The data structure with specified keys removed.
         """
-        if isinstance(data, dict):
-            return {
-                key: WikidataEntity._remove_keys(value, keys_to_remove)
-                for key, value in data.items() if key not in keys_to_remove
-            }
-        elif isinstance(data, list):
-            return [WikidataEntity._remove_keys(item, keys_to_remove) for item in data]
-        else:
-            return data
+        stack = [data]
+        while len(stack) > 0:
+            node = stack.pop()
+            if isinstance(node, dict):
+                for key in keys_to_remove:
+                    node.pop(key, None)
+                stack.extend(node.values())
+            elif isinstance(node, list):
+                stack.extend(node)
+        return data
 
     @staticmethod
     def _get_claims(item):
@@ -232,17 +294,17 @@ class WikidataID(Base):
         worked = False
         with Session() as session:
             try:
-                session.execute(
-                    text(
-                        """
-                        INSERT INTO wikidataID (id, in_wikipedia, is_property)
-                        VALUES (:id, :in_wikipedia, :is_property)
-                        ON CONFLICT(id) DO UPDATE
-                        SET
-                            in_wikipedia = CASE WHEN excluded.in_wikipedia = TRUE THEN excluded.in_wikipedia ELSE wikidataID.in_wikipedia END,
-                            is_property = CASE WHEN excluded.is_property = TRUE THEN excluded.is_property ELSE wikidataID.is_property END
-                        """
-                    ),
+                execute_multi_values(
+                    session,
+                    """
+                    INSERT INTO wikidataID (id, in_wikipedia, is_property)
+                    VALUES {values}
+                    ON CONFLICT(id) DO UPDATE
+                    SET
+                        in_wikipedia = CASE WHEN excluded.in_wikipedia = TRUE THEN excluded.in_wikipedia ELSE wikidataID.in_wikipedia END,
+                        is_property = CASE WHEN excluded.is_property = TRUE THEN excluded.is_property ELSE wikidataID.is_property END
+                    """,
+                    ['id', 'in_wikipedia', 'is_property'],
                     data
                 )
                 session.commit()
@@ -320,46 +382,43 @@ class WikidataID(Base):
         - language: The language code to use for extracting data (default is 'en').
 
         Returns:
-        - A list of dictionaries containing entity IDs and their properties.
+        - A list of dictionaries containing entity IDs and their properties, with each ID appearing once.
         """
         if item is None:
             return []
 
-        batch_ids = [{'id': item['id'], 'in_wikipedia': WikidataID.is_in_wikipedia(item, language=language), 'is_property': False}]
-
-        for pid,claim in item.get('claims', {}).items():
-            batch_ids.append({'id': pid, 'in_wikipedia': False, 'is_property': True})
+        # IDs repeat a lot within an item, so each one is only returned once. Its flags are merged with an OR, as add_bulk_ids does on conflict.
+        item_ids = set()
+        property_ids = set()
+        for pid, claim in item.get('claims', {}).items():
+            property_ids.add(pid)
 
             for c in claim:
-                if ('mainsnak' in c) and ('datavalue' in c['mainsnak']):
-                    if (c['mainsnak'].get('datatype', '') == 'wikibase-item'):
-                        id = c['mainsnak']['datavalue']['value']['id']
-                        batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': False})
-
-                    elif (c['mainsnak'].get('datatype', '') == 'wikibase-property'):
-                        id = c['mainsnak']['datavalue']['value']['id']
-                        batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': True})
-
-                    elif (c['mainsnak'].get('datatype', '') == 'quantity') and (c['mainsnak']['datavalue']['value'].get('unit', '1') != '1'):
-                        id = c['mainsnak']['datavalue']['value']['unit'].rsplit('/', 1)[1]
-                        batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': False})
-
-                if 'qualifiers' in c:
-                    for pid, qualifier in c['qualifiers'].items():
-                        batch_ids.append({'id': pid, 'in_wikipedia': False, 'is_property': True})
-                        for q in qualifier:
-                            if ('datavalue' in q):
-                                if (q['datatype'] == 'wikibase-item'):
-                                    id = q['datavalue']['value']['id']
-                                    batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': False})
-
-                                elif(q['datatype'] == 'wikibase-property'):
-                                    id = q['datavalue']['value']['id']
-                                    batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': True})
-
-                                elif (q['datatype'] == 'quantity') and (q['datavalue']['value'].get('unit', '1') != '1'):
-                                    id = q['datavalue']['value']['unit'].rsplit('/', 1)[1]
-                                    batch_ids.append({'id': id, 'in_wikipedia': False, 'is_property': False})
+                snaks = [c['mainsnak']] if 'mainsnak' in c else []
+                for qualifier_pid, qualifier in c.get('qualifiers', {}).items():
+                    property_ids.add(qualifier_pid)
+                    snaks.extend(qualifier)
+
+                for snak in snaks:
+                    if 'datavalue' not in snak:
+                        continue
+
+                    datatype = snak.get('datatype', '')
+                    if datatype == 'wikibase-item':
+                        item_ids.add(snak['datavalue']['value']['id'])
+
+                    elif datatype == 'wikibase-property':
+                        property_ids.add(snak['datavalue']['value']['id'])
+
+                    elif datatype == 'quantity':
+                        unit = snak['datavalue']['value'].get('unit', '1')
+                        if unit != '1':
+                            item_ids.add(unit.rsplit('/', 1)[1])
+
+        entity_id = item['id']
+        batch_ids = [{'id': entity_id, 'in_wikipedia': WikidataID.is_in_wikipedia(item, language=language), 'is_property': entity_id in property_ids}]
+        batch_ids.extend({'id': id, 'in_wikipedia': False, 'is_property': True} for id in property_ids if id != entity_id)
+        batch_ids.extend({'id': id, 'in_wikipedia': False, 'is_property': False} for id in item_ids - property_ids if id != entity_id)
         return batch_ids
 
 Base.metadata.create_all(engine)
\ No newline at end of file
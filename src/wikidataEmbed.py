@@ -1,6 +1,7 @@
 from datetime import datetime, date
 import re
 from typing import List
+from functools import lru_cache
 from wikidataDB import WikidataEntity
 from transformers import AutoModel, AutoTokenizer
 import torch
@@ -20,6 +21,57 @@ class WikidataTextifier:
         self.with_claim_aliases = with_claim_aliases
         self.with_property_desc = with_property_desc
         self.with_property_aliases = with_property_aliases
+        self.prefetched_entities = {}
+        self.cached_properties = {} # Properties are few and shared by most entities, so they are kept across calls
+
+    def get_entity(self, entity_id):
+        """
+        Retrieves an entity from the prefetched entities of the claims being converted, falling back to a database query.
+
+        Parameters:
+        - entity_id: The unique identifier of the entity.
+
+        Returns:
+        - The entity object if found, otherwise None.
+        """
+        if entity_id in self.prefetched_entities:
+            return self.prefetched_entities[entity_id]
+        if entity_id in self.cached_properties:
+            return self.cached_properties[entity_id]
+        return WikidataEntity.get_entity(entity_id)
+
+    def prefetch_entities(self, *properties):
+        """
+        Fetches in bulk all the properties and entities referenced by one or more sets of claims, so converting them to text doesn't query the database once per value.
+        Prefetching the claims of several entities at once lets the following calls for each of them skip the database entirely.
+
+        Parameters:
+        - properties: One or more dictionaries of properties (claims) with property IDs as keys.
+        """
+        ids = set()
+        for entity_properties in properties:
+            for pid, claim in entity_properties.items():
+                ids.add(pid)
+                for c in claim:
+                    snaks = [c.get('mainsnak', c)]
+                    for qualifier_pid, qualifier in c.get('qualifiers', {}).items():
+                        ids.add(qualifier_pid)
+                        snaks.extend(qualifier)
+
+                    for snak in snaks:
+                        if (snak.get('snaktype', '') == 'value') and (snak.get('datatype', '') in ('wikibase-item', 'wikibase-property')):
+                            ids.add(snak['datavalue']['value']['id'])
+
+        ids = ids - self.cached_properties.keys()
+        missing_ids = ids - self.prefetched_entities.keys()
+        if len(missing_ids) == 0:
+            return
+
+        entities = WikidataEntity.get_entities(missing_ids, with_claims=False) # Only labels, descriptions and aliases of referenced entities are used
+        self.prefetched_entities = {entity_id: self.prefetched_entities[entity_id] if entity_id in self.prefetched_entities else entities.get(entity_id) for entity_id in ids} # Missing IDs are stored as None so they aren't queried again
+        for entity_id in missing_ids:
+            if entity_id.startswith('P'):
+                self.cached_properties[entity_id] = self.prefetched_entities[entity_id]
 
     def merge_entity_property_text(self, entity_description, properties):
         """
@@ -72,7 +124,7 @@ class WikidataTextifier:
         if mainsnak.get('snaktype', '') == 'value':
             if (mainsnak.get('datatype', '') == 'wikibase-item') or (mainsnak.get('datatype', '') == 'wikibase-property'):
                 entity_id = mainsnak['datavalue']['value']['id']
-                entity = WikidataEntity.get_entity(entity_id)
+                entity = self.get_entity(entity_id)
                 if entity is None:
                     return None
 
@@ -130,7 +182,7 @@ class WikidataTextifier:
                     q_data.append(value)
 
             if len(q_data) > 0:
-                property = WikidataEntity.get_entity(pid)
+                property = self.get_entity(pid)
                 if property:
                     if len(text) > 0:
                         text += ' ; '
@@ -148,6 +200,8 @@ class WikidataTextifier:
         Returns:
         - A string representation of the properties and their values.
         """
+        self.prefetch_entities(properties)
+
         properties_text = []
         for pid, claim in properties.items():
             p_data = []
@@ -161,7 +215,7 @@ class WikidataTextifier:
                     p_data.append(value)
 
             if len(p_data) > 0:
-                property = WikidataEntity.get_entity(pid)
+                property = self.get_entity(pid)
                 if property:
                     text = f"\n- {property.label}"
                     if self.with_property_desc:
@@ -195,7 +249,7 @@ class WikidataTextifier:
             unit = None
         else:
             unit_qid = unit.rsplit('/')[1]
-            entity = WikidataEntity.get_entity(unit_qid)
+            entity = self.get_entity(unit_qid)
             if entity:
                 unit = entity.label
 
@@ -295,49 +349,64 @@ class WikidataTextifier:
         if len(tokens['input_ids']) < max_length:
             return [entity_text]
 
+        # Tokenize the label/description, the text preceding the claims and every claim in a single batched call, instead of re-tokenizing the growing chunk for every claim.
+        header = self.merge_entity_property_text(entity_description, [""])
+        tokens = tokenizer([entity_description, header, *properties], add_special_tokens=False, return_offsets_mapping=True)
+        description_offsets = tokens['offset_mapping'][0]
+        header_length = len(tokens['input_ids'][1])
+        claims_length = [len(token_ids) for token_ids in tokens['input_ids'][2:]]
+
         # If the label and description already exceed the maximum tokens then we will truncate it and will not include chunks that include claims.
-        tokens = tokenizer(entity_description, add_special_tokens=False, return_offsets_mapping=True)
-        token_ids, offsets = tokens['input_ids'], tokens['offset_mapping']
-        if len(token_ids) >= max_length:
-            start, end = offsets[0][0], offsets[max_length - 1][1]
+        if len(description_offsets) >= max_length:
+            start, end = description_offsets[0][0], description_offsets[max_length - 1][1]
             return [entity_text[start:end]]  # Return the truncated portion of the original text
 
         # Create the chunks assuming the description/label text is smaller than the maximum tokens.
+        # Claims start with a newline, so the token length of a chunk is the header length plus the length of each of its claims.
         chunks = []
         chunk_claims = []
-        for claim in properties:
-            entity_text = self.merge_entity_property_text(entity_description, chunk_claims+[claim])
-            tokens = tokenizer(entity_text, add_special_tokens=False, return_offsets_mapping=True)
-            token_ids, offsets = tokens['input_ids'], tokens['offset_mapping']
-
+        chunk_length = header_length
+        for claim, claim_length in zip(properties, claims_length):
             # Check when including the current claim if we exceed the maximum tokens.
-            if len(token_ids) >= max_length:
-                start, end = offsets[0][0], offsets[max_length - 1][1]
-                chunks.append(entity_text[start:end])
+            if chunk_length + claim_length >= max_length:
+                entity_text = self.merge_entity_property_text(entity_description, chunk_claims+[claim])
+                chunks.append(self._truncate_text(entity_text, tokenizer, max_length))
                 if len(chunk_claims) == 0:
                     # If we do exceed it but there's no claim previously added to the chunks, then it means the current claim alone exceeds the maximum tokens, and we already included it in a trimmed chunk alone.
                     chunk_claims = []
+                    chunk_length = header_length
                 else:
                     # Include the claim in a new chunk so where it's information doesn't get trimmed.
                     chunk_claims = [claim]
+                    chunk_length = header_length + claim_length
             else:
                 chunk_claims.append(claim)
+                chunk_length += claim_length
 
         if len(chunk_claims) > 0:
             entity_text = self.merge_entity_property_text(entity_description, chunk_claims)
-            tokens = tokenizer(entity_text, add_special_tokens=False, return_offsets_mapping=True)
-            token_ids, offsets = tokens['input_ids'], tokens['offset_mapping']
-
-            if len(token_ids) >= max_length:
-                start, end = offsets[0][0], offsets[max_length - 1][1]
-            else:
-                start, end = offsets[0][0], offsets[-1][1]
-            chunks.append(entity_text[start:end])
+            chunks.append(self._truncate_text(entity_text, tokenizer, max_length))
 
         return chunks
 
+    def _truncate_text(self, text, tokenizer, max_length):
+        """
+        Truncates a text to its first max_length tokens.
+
+        Parameters:
+        - text: The text to truncate.
+        - tokenizer: A fast tokenizer that returns offset mappings.
+        - max_length: The maximum number of tokens to keep.
+
+        Returns:
+        - The portion of the text covered by its first max_length tokens.
+        """
+        offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+        start, end = offsets[0][0], offsets[min(max_length, len(offsets)) - 1][1]
+        return text[start:end]
+
 class JinaAIEmbeddings:
-    def __init__(self, passage_task="retrieval.passage", query_task="retrieval.query", embedding_dim=1024):
+    def __init__(self, passage_task="retrieval.passage", query_task="retrieval.query", embedding_dim=1024, query_cache_size=100000):
         """
         Initializes the JinaAIEmbeddings class with the model, tokenizer, and task identifiers.
 
@@ -345,12 +414,20 @@ class JinaAIEmbeddings:
         - passage_task: Task identifier for embedding documents (default: "retrieval.passage").
         - query_task: Task identifier for embedding queries (default: "retrieval.query").
         - embedding_dim: The dimensionality of the embeddings (default: 1024).
+        - query_cache_size: Maximum number of query embeddings kept in memory, so repeated queries skip the model (default: 100000).
+
+        On GPU the model runs in half precision, BF16 when supported and FP16 otherwise.
         """
         self.passage_task = passage_task
         self.query_task = query_task
         self.embedding_dim = embedding_dim
 
         self.model = AutoModel.from_pretrained("jinaai/jina-embeddings-v3", trust_remote_code=True)
+        if torch.cuda.is_available():
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            self.model = self.model.to('cuda', dtype=dtype)
+        self.model.eval()
+        self._cached_embed_query = lru_cache(maxsize=query_cache_size)(self._embed_query)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """
@@ -362,7 +439,7 @@ class JinaAIEmbeddings:
         Returns:
         - A list of embeddings, each corresponding to a document, with a dimensionality specified by embedding_dim.
         """
-        with torch.no_grad():
+        with torch.inference_mode():
             return self.model.encode(texts, task=self.passage_task, truncate_dim=self.embedding_dim)
 
     def embed_query(self, query: str) -> List[float]:
@@ -375,5 +452,17 @@ class JinaAIEmbeddings:
         Returns:
         - A single embedding as a list of floats with a dimensionality specified by embedding_dim.
         """
-        with torch.no_grad():
-            return self.model.encode([query], task=self.query_task, truncate_dim=self.embedding_dim)[0]
\ No newline at end of file
+        return list(self._cached_embed_query(query)) # A new list per call, so callers modifying it can't corrupt the cached embedding
+
+    def _embed_query(self, query):
+        """
+        Runs the model on a single query, called by embed_query through its cache.
+
+        Parameters:
+        - query: The query string to embed.
+
+        Returns:
+        - A single embedding as an immutable tuple of floats with a dimensionality specified by embedding_dim.
+        """
+        with torch.inference_mode():
+            return tuple(self.model.encode([query], task=self.query_task, truncate_dim=self.embedding_dim)[0].tolist())
\ No newline at end of file
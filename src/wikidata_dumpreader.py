@@ -1,14 +1,28 @@
 import gzip
 import bz2
+import io
+import mmap
+import os
 import orjson
 import asyncio
 import time
 import psutil
 from tqdm import tqdm
-from multiprocessing import Queue, Value
+from queue import Queue, Full
+import threading
+
+try:
+    import indexed_bzip2  # Parallel bz2 decompression, falls back to the single-threaded bz2 module
+except ImportError:
+    indexed_bzip2 = None
+
+try:
+    import zstandard  # Only needed to read zstd compressed dumps
+except ImportError:
+    zstandard = None
 
 class WikidataDumpReader:
-    def __init__(self, file_path, num_processes=4, batch_size=1000, queue_size=1000, skiplines=0):
+    def __init__(self, file_path, num_processes=4, batch_size=1000, queue_size=1000, skiplines=0, line_filter=None, decompression_threads=None):
         """
         Initializes the reader with the file path, number of processes for multiprocessing,
         and batch size for reading lines.
@@ -19,16 +33,23 @@ class WikidataDumpReader:
         - batch_size: Number of lines to read in each batch (default is 1000).
         - queue_size: Maximum size of the queue (default is 10000).
         - skiplines: Number of lines to skip at the beginning of the file (default is 0).
+        - line_filter: A substring that a line must contain to be parsed. Lines without it are skipped before any JSON parsing (default is None, all lines are parsed).
+        - decompression_threads: Number of threads decompressing bz2 files with indexed_bzip2 (default is None, same as num_processes).
         """
         self.file_path = file_path
         self.extension = file_path.split(".")[-1]
         self.num_processes = num_processes
         self.batch_size = batch_size
         self.skiplines = skiplines
-        self.queue = Queue(maxsize=queue_size)
+        self.line_filter = line_filter
+        self.decompression_threads = decompression_threads or num_processes
+        self.queue = Queue(maxsize=queue_size) # The producer and consumers are threads, so batches are passed by reference instead of being pickled
 
-        self.finished = Value('i', False)
-        self.iterations = Value('i', 0)
+        # The producer and consumers are threads, so plain thread primitives replace shared-memory values and their semaphores
+        self.finished = threading.Event()
+        self.failed = threading.Event() # Set when a thread raises, so the others stop instead of waiting on the queue forever
+        self.iterations = 0
+        self.iterations_lock = threading.Lock()
 
     def lines_to_entities(self, lines):
         """
@@ -88,17 +109,17 @@ class WikidataDumpReader:
         - Prints progress and memory usage statistics.
         """
         start = time.time()
-        while (not self.finished.value) or (not self.queue.empty()):
+        while ((not self.finished.is_set()) or (not self.queue.empty())) and (not self.failed.is_set()):
             time.sleep(3)
 
             time_per_iteration_s = time.time() - start
-            lines_per_s = self.iterations.value / time_per_iteration_s
+            lines_per_s = self.iterations / time_per_iteration_s
 
             process = psutil.Process()
             memory_info = process.memory_info()
             memory_usage_mb = memory_info.rss / 1024 ** 2
 
-            print(f"Items Processes: {self.iterations.value} \t Line Process Avg: {lines_per_s:.0f} items/sec \t Memory Usage Avg: {memory_usage_mb:.2f} MB")
+            print(f"Items Processes: {self.iterations} \t Line Process Avg: {lines_per_s:.0f} items/sec \t Memory Usage Avg: {memory_usage_mb:.2f} MB")
 
     def _producer(self, max_iterations):
         """
@@ -107,26 +128,36 @@ class WikidataDumpReader:
         Parameters:
         - max_iterations: Maximum number of iterations for reading lines (default is None).
         """
-        with self.finished.get_lock():
-            self.finished.value = False
-
-        iters = 0
-        if self.extension == 'json':
-            read_lines = self._read_jsonfile()
-        elif self.extension in ['gz', 'bz2']:
-            read_lines = self._read_zipfile()
-        else:
-            raise ValueError("File extension is not supported")
+        self.finished.clear()
 
-        for lines_batch in read_lines:
-            self.queue.put(lines_batch)
+        try:
+            iters = 0
+            if self.extension == 'json':
+                read_lines = self._read_jsonfile()
+            elif self.extension in ['gz', 'bz2', 'zst']:
+                read_lines = self._read_zipfile()
+            else:
+                raise ValueError("File extension is not supported")
 
-            iters += 1
-            if max_iterations and (iters >= max_iterations):
-                break
+            for lines_batch in read_lines:
+                # Wait for room in the queue, unless the consumers have failed and will never empty it
+                while not self.failed.is_set():
+                    try:
+                        self.queue.put(lines_batch, timeout=1)
+                        break
+                    except Full:
+                        pass
+                if self.failed.is_set():
+                    break
 
-        with self.finished.get_lock():
-            self.finished.value = True
+                iters += 1
+                if max_iterations and (iters >= max_iterations):
+                    break
+        except BaseException:
+            self.failed.set()
+            raise
+        finally:
+            self.finished.set()
 
     def _consumer(self, handler_func):
         """
@@ -135,57 +166,106 @@ class WikidataDumpReader:
         Parameters:
         - handler_func: A function to process each entity.
         """
-        while (not self.finished.value) or (not self.queue.empty()):
+        while ((not self.finished.is_set()) or (not self.queue.empty())) and (not self.failed.is_set()):
             lines_batch = None
             try:
                 lines_batch = self.queue.get(timeout=1)
             except Exception as e:
-                if self.finished.value:
+                if self.finished.is_set():
                     break
 
             if lines_batch:
-                entities_batch = self.lines_to_entities(lines_batch)
+                try:
+                    entities_batch = self.lines_to_entities(lines_batch)
 
-                for entity in entities_batch:
-                    if entity:
-                        handler_func(entity)
+                    for entity in entities_batch:
+                        if entity:
+                            handler_func(entity)
+                except BaseException:
+                    self.failed.set()
+                    raise
 
-                with self.iterations.get_lock():
-                    self.iterations.value += len(entities_batch)
+                with self.iterations_lock:
+                    self.iterations += len(entities_batch)
+
+    def _batch_lines(self, file):
+        """
+        Groups the lines of an open file in batches, skipping the lines that don't contain line_filter.
+
+        Parameters:
+        - file: A file object opened in text mode.
+
+        Yields:
+        - A batch of lines joined in a single string.
+        """
+        while True:
+            lines_batch = []
+            line = None
+            while len(lines_batch) < self.batch_size:
+                line = file.readline()
+                if not line:
+                    break
+                if (self.line_filter is None) or (self.line_filter in line):
+                    lines_batch.append(line)
+
+            if len(lines_batch) > 0:
+                yield ''.join(lines_batch)
+            if not line:
+                break
+
+    def _batch_mmap_lines(self, mm, start=0):
+        """
+        Groups the lines of a memory-mapped file in batches, skipping the lines that don't contain line_filter.
+        Line boundaries and the filter are searched directly in the mapped bytes, so only the kept lines are copied and decoded, once per batch.
+
+        Parameters:
+        - mm: A read-only mmap of the file.
+        - start: Byte offset of the first line to read (default is 0).
+
+        Yields:
+        - A batch of lines joined in a single string.
+        """
+        size = len(mm)
+        line_filter = self.line_filter.encode('utf-8') if self.line_filter is not None else None
+
+        while start < size:
+            lines_batch = []
+            while (len(lines_batch) < self.batch_size) and (start < size):
+                end = mm.find(b'\n', start) + 1 or size
+                if (line_filter is None) or (mm.find(line_filter, start, end) != -1):
+                    lines_batch.append(mm[start:end])
+                start = end
+
+            if len(lines_batch) > 0:
+                yield b''.join(lines_batch).decode('utf-8')
 
     def _read_jsonfile(self):
         """
         Reads lines from a JSON file in batches.
+        The file is memory-mapped instead of read line by line through a text buffer.
 
         Yields:
         - A batch of lines from the JSON file.
         """
-        file = None
-        try:
-            file = open(self.file_path, mode="r")
-            for _ in tqdm(range(self.skiplines)):
-                file.readline()
+        if os.path.getsize(self.file_path) == 0:
+            return
 
-            while True:
-                lines_batch = ''
-                for _ in range(self.batch_size):
-                    line = file.readline()
-                    if not line:
-                        break
-                    lines_batch = lines_batch + line
+        with open(self.file_path, mode="rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)  # Let the kernel read ahead aggressively
 
-                if lines_batch == '':
-                    break
-                yield lines_batch
+            start = 0
+            for _ in tqdm(range(self.skiplines)):
+                start = mm.find(b'\n', start) + 1 or len(mm)
 
-        finally:
-            if file:
-                file.close()
+            yield from self._batch_mmap_lines(mm, start)
 
 
     def _read_zipfile(self):
         """
-        Reads lines from a compressed file (gzip or bz2) in batches.
+        Reads lines from a compressed file (gzip, bz2 or zstd) in batches.
+        bz2 files are decompressed in parallel with indexed_bzip2 when it is installed.
+        zstd files require the zstandard package, and decompress several times faster than gzip or bz2.
 
         Yields:
         - A batch of lines from the compressed file.
@@ -195,24 +275,24 @@ class WikidataDumpReader:
             if self.extension == 'gz':
                 file = gzip.open(self.file_path, "rt")
             elif self.extension == 'bz2':
-                file = bz2.open(self.file_path, "rt")
+                if indexed_bzip2 is not None:
+                    # Large buffered reads keep all the decompression threads busy, instead of pulling 8 KB at a time
+                    file = io.TextIOWrapper(io.BufferedReader(indexed_bzip2.open(self.file_path, parallelization=self.decompression_threads), buffer_size=4 << 20), encoding='utf-8')
+                else:
+                    file = bz2.open(self.file_path, "rt")
+            elif self.extension == 'zst':
+                if zstandard is None:
+                    raise ImportError("The zstandard package is required to read .zst files")
+                # Dumps compressed with --long use windows larger than the decompressor's default limit, and multi-threaded compressors may write several frames
+                reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(open(self.file_path, 'rb'), read_across_frames=True)
+                file = io.TextIOWrapper(reader, encoding='utf-8')
             else:
                 raise ValueError("Zip file extension is not supported")
 
             for _ in range(self.skiplines):
                 file.readline()
 
-            while True:
-                lines_batch = ''
-                for _ in range(self.batch_size):
-                    line = file.readline()
-                    if not line:
-                        break
-                    lines_batch = lines_batch + line
-
-                if lines_batch == '':
-                    break
-                yield lines_batch
+            yield from self._batch_lines(file)
 
         finally:
             if file: